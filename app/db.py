@@ -2,8 +2,9 @@
 from dotenv import load_dotenv
 load_dotenv()   # carga variables desde .env en la raíz del proyecto
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from contextlib import contextmanager
 import os
 
 DB_URL = os.getenv("DATABASE_URL")
@@ -15,6 +16,73 @@ engine = create_engine(DB_URL, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Claves de pg_advisory_lock para tareas que no deben correr en paralelo entre workers
+MIGRATE_RAW_TEXT_LOCK = 2601
+BOOTSTRAP_PROFILES_LOCK = 2801
+
 def init_db():
     from . import models
     Base.metadata.create_all(bind=engine)
+
+@contextmanager
+def advisory_lock(key: int):
+    """
+    Lock de sesión de PostgreSQL (pg_advisory_lock) mientras dura el bloque.
+    En otros motores (p.ej. SQLite) no bloquea.
+    """
+    with engine.connect() as conn:
+        locking = engine.dialect.name == "postgresql"
+        if locking:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+        try:
+            yield
+        finally:
+            if locking:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+
+def _copy_raw_text_batch(conn, batch_size: int) -> int:
+    from .models import InvoiceRawText
+
+    # Solo filas aún no copiadas: una migración interrumpida se reanuda sola
+    rows = conn.execute(
+        text(
+            "SELECT i.id, i.raw_text FROM invoices i "
+            "LEFT JOIN invoice_raw_texts r ON r.invoice_id = i.id "
+            "WHERE i.raw_text IS NOT NULL AND r.invoice_id IS NULL "
+            "ORDER BY i.id LIMIT :limit"
+        ),
+        {"limit": batch_size},
+    ).fetchall()
+    values = []
+    for invoice_id, raw_text in rows:
+        codec, data = InvoiceRawText.encode(raw_text)
+        values.append({"invoice_id": invoice_id, "codec": codec, "data": data})
+    if values:
+        conn.execute(InvoiceRawText.__table__.insert(), values)
+    return len(values)
+
+def migrate_raw_text(batch_size: int = 500):
+    """
+    Migra `invoices.raw_text` (esquema anterior) a la tabla `invoice_raw_texts`
+    comprimida y elimina la columna. Es idempotente: si la columna ya no existe no hace nada.
+    Se ejecuta explícitamente con `python -m app.migrate`, no al importar la app.
+    """
+    with advisory_lock(MIGRATE_RAW_TEXT_LOCK):
+        columns = {c["name"] for c in inspect(engine).get_columns("invoices")}
+        if "raw_text" not in columns:
+            return
+
+        # Copia por lotes sin bloquear la tabla
+        while True:
+            with engine.begin() as conn:
+                if not _copy_raw_text_batch(conn, batch_size):
+                    break
+
+        # Último barrido y DROP en la misma transacción, con la tabla bloqueada,
+        # para no perder texto de filas escritas mientras tanto
+        with engine.begin() as conn:
+            if engine.dialect.name == "postgresql":
+                conn.execute(text("LOCK TABLE invoices IN ACCESS EXCLUSIVE MODE"))
+            while _copy_raw_text_batch(conn, batch_size):
+                pass
+            conn.execute(text("ALTER TABLE invoices DROP COLUMN raw_text"))
@@ -1,17 +1,23 @@
 # app/main.py
 import os
+import io
+import asyncio
+import csv
 import json
 import shutil
+from datetime import date, datetime, time, timedelta, timezone
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Literal, Optional
+from zoneinfo import ZoneInfo
 
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Request, Form, Query, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, load_only, undefer
 
-from . import db, models, ocr, nlp, email_service, utils
+from . import db, models, ocr, nlp, email_service, utils, profiles
 from .schemas import InvoiceCreateResponse, InvoiceStatus
 
 # --- Configuración de directorios ---
@@ -31,6 +37,19 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 # Inicializar base de datos (crea tablas si no existen)
 db.init_db()
 
+# Columnas incluidas en la exportación CSV/NDJSON (en este orden)
+EXPORT_COLUMNS = (
+    "id", "provider_name", "invoice_number", "issue_date", "due_date",
+    "total_amount", "taxes", "state", "created_at", "extracted",
+)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Zona horaria en la que se interpretan date_from/date_to de la exportación (por defecto UTC)
+EXPORT_TIMEZONE = os.getenv("EXPORT_TIMEZONE", "UTC")
+EXPORT_TZ = timezone.utc if EXPORT_TIMEZONE == "UTC" else ZoneInfo(EXPORT_TIMEZONE)
+
+# Columnas que necesitan los handlers de acciones/webhook (sin raw_text ni extracted)
+ACTION_COLUMNS = (models.Invoice.id, models.Invoice.state, models.Invoice.invoice_number)
+
 # Dependencia para obtener sesión DB
 def get_db():
     session = db.SessionLocal()
@@ -40,6 +59,53 @@ def get_db():
         session.close()
 
 
+# --------------------------------------------------
+# Perfiles de proveedor: índice en memoria por worker
+# --------------------------------------------------
+# Cada worker recarga el índice desde BD cada PROFILE_RELOAD_SECONDS; un perfil aprendido
+# en otro worker tarda como máximo ese intervalo en usarse aquí.
+PROFILE_RELOAD_SECONDS = int(os.getenv("PROFILE_RELOAD_SECONDS", "300"))
+
+
+def reload_profiles():
+    with db.SessionLocal() as session:
+        profiles.load_index(session)
+
+
+async def _reload_profiles_periodically():
+    while True:
+        await asyncio.sleep(PROFILE_RELOAD_SECONDS)
+        try:
+            await run_in_threadpool(reload_profiles)
+        except Exception as e:
+            print("Profile reload error:", e)
+
+
+@app.on_event("startup")
+async def load_profiles():
+    """
+    Carga los perfiles al arrancar el worker (solo lectura; el aprendizaje inicial
+    a partir del historial se hace con `python -m app.migrate`).
+    """
+    await run_in_threadpool(reload_profiles)
+    app.state.profile_reload_task = asyncio.create_task(_reload_profiles_periodically())
+
+
+def learn_profile(invoice_id: int):
+    """
+    Tarea en segundo plano: aprende el perfil del proveedor de una factura aprobada.
+    Usa su propia sesión y un fallo aquí no afecta a la aprobación.
+    """
+    session = db.SessionLocal()
+    try:
+        profiles.learn_from_invoice(session, invoice_id)
+    except Exception as e:
+        session.rollback()
+        print("Profile error:", e)
+    finally:
+        session.close()
+
+
 # ----------------------------
 # Endpoint: subir factura (API)
 # ----------------------------
@@ -124,12 +190,108 @@ async def upload_invoice(
     return {"id": inv.id, "state": inv.state.value}
 
 
+# -------------------------------------------
+# Endpoint: exportación masiva (CSV / NDJSON)
+# -------------------------------------------
+def _export_rows(state, date_from, date_to, cursor):
+    """
+    Lee facturas por orden de id con un cursor del lado del servidor (yield_per),
+    así la memoria se mantiene constante sin importar el tamaño de la exportación.
+    """
+    session = db.SessionLocal()
+    try:
+        query = session.query(*(getattr(models.Invoice, c) for c in EXPORT_COLUMNS))
+        if state is not None:
+            query = query.filter(models.Invoice.state == state)
+        # Límites explícitos con zona horaria: no dependen del TimeZone de la sesión de PostgreSQL
+        if date_from is not None:
+            start = datetime.combine(date_from, time.min, tzinfo=EXPORT_TZ)
+            query = query.filter(models.Invoice.created_at >= start)
+        if date_to is not None:
+            end = datetime.combine(date_to + timedelta(days=1), time.min, tzinfo=EXPORT_TZ)
+            query = query.filter(models.Invoice.created_at < end)
+        if cursor is not None:
+            query = query.filter(models.Invoice.id > cursor)
+        for row in query.order_by(models.Invoice.id).yield_per(EXPORT_BATCH_SIZE):
+            record = dict(zip(EXPORT_COLUMNS, row))
+            record["state"] = record["state"].value if record["state"] else None
+            record["created_at"] = record["created_at"].isoformat() if record["created_at"] else None
+            yield record
+    finally:
+        session.close()
+
+
+def _export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, record in enumerate(rows, start=1):
+        record["extracted"] = json.dumps(record["extracted"], ensure_ascii=False) if record["extracted"] else ""
+        writer.writerow([record[c] for c in EXPORT_COLUMNS])
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def _export_ndjson(rows):
+    chunk = []
+    for record in rows:
+        chunk.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    yield "".join(chunk)
+
+
+@app.get("/invoices/export")
+def export_invoices(
+    export_format: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+    state: Optional[models.InvoiceState] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    cursor: Optional[int] = None,
+):
+    """
+    Exporta facturas en streaming, ordenadas por id. Filtros opcionales por estado
+    y rango de fecha de creación (inclusive, en EXPORT_TIMEZONE). Si la conexión se corta, reanudar
+    pasando `cursor` = último id recibido.
+    """
+    rows = _export_rows(state, date_from, date_to, cursor)
+    if export_format == "csv":
+        body, media_type = _export_csv(rows), "text/csv"
+    else:
+        body, media_type = _export_ndjson(rows), "application/x-ndjson"
+    filename = f"invoices.{export_format}"
+    return StreamingResponse(
+        body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# -------------------------------------------------
+# Endpoint: métricas de extracción por perfiles
+# -------------------------------------------------
+@app.get("/profiles/stats")
+def profile_stats():
+    """
+    Tasa de acierto del índice de perfiles y tiempo medio por ruta de extracción.
+    Los contadores viven en memoria: son los del worker que atiende la petición (worker_pid).
+    """
+    return {"worker_pid": os.getpid(), **nlp.extraction_stats()}
+
+
 # -----------------------------------
 # Endpoint: consultar factura y estado
 # -----------------------------------
 @app.get("/invoices/{invoice_id}", response_model=InvoiceStatus)
 def get_invoice(invoice_id: int, db_session: Session = Depends(get_db)):
-    inv = db_session.query(models.Invoice).filter(models.Invoice.id == invoice_id).first()
+    inv = (
+        db_session.query(models.Invoice)
+        .options(undefer(models.Invoice.extracted))
+        .filter(models.Invoice.id == invoice_id)
+        .first()
+    )
     if not inv:
         raise HTTPException(status_code=404, detail="Invoice not found")
     history = [
@@ -161,7 +323,7 @@ def action_get(token: str):
 
 
 @app.get("/action/confirm/{token}", response_class=HTMLResponse)
-def action_confirm(token: str, db_session: Session = Depends(get_db)):
+def action_confirm(token: str, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)):
     """
     Ejecuta la aprobación y registra el historial.
     """
@@ -172,19 +334,24 @@ def action_confirm(token: str, db_session: Session = Depends(get_db)):
     if payload.get("action") != "approve":
         return HTMLResponse("<h3>Acción inválida</h3>", status_code=400)
 
-    inv = db_session.query(models.Invoice).get(payload.get("id"))
+    inv = db_session.query(models.Invoice).options(load_only(*ACTION_COLUMNS)).get(payload.get("id"))
     if not inv:
         return HTMLResponse("<h3>Factura no encontrada</h3>", status_code=404)
 
-    prev = inv.state.value
-    inv.state = models.InvoiceState.APPROVED
+    # Guardar lo necesario antes del commit: leer `inv` después recargaría toda la fila
+    invoice_id, label, prev = inv.id, inv.invoice_number or inv.id, inv.state.value
+    new_state = models.InvoiceState.APPROVED
+    inv.state = new_state
     db_session.add(inv)
     db_session.commit()
     db_session.add(
-        models.InvoiceHistory(invoice_id=inv.id, from_state=prev, to_state=inv.state.value, comment="Aprobado vía email")
+        models.InvoiceHistory(invoice_id=invoice_id, from_state=prev, to_state=new_state.value, comment="Aprobado vía email")
     )
     db_session.commit()
-    return HTMLResponse(f"<h3>Factura {inv.invoice_number or inv.id} aprobada. Gracias.</h3>")
+    # Solo en la primera aprobación (un link pulsado dos veces no vuelve a sumar muestras)
+    if prev != models.InvoiceState.APPROVED.value:
+        background_tasks.add_task(learn_profile, invoice_id)
+    return HTMLResponse(f"<h3>Factura {label} aprobada. Gracias.</h3>")
 
 
 @app.get("/action/reject_form/{token}", response_class=HTMLResponse)
@@ -218,17 +385,19 @@ def reject_confirm(token: str = Form(...), comment: str = Form(...), db_session:
     if payload.get("action") != "reject":
         return HTMLResponse("<h3>Acción inválida</h3>", status_code=400)
 
-    inv = db_session.query(models.Invoice).get(payload.get("id"))
+    inv = db_session.query(models.Invoice).options(load_only(*ACTION_COLUMNS)).get(payload.get("id"))
     if not inv:
         return HTMLResponse("<h3>Factura no encontrada</h3>", status_code=404)
 
-    prev = inv.state.value
-    inv.state = models.InvoiceState.REJECTED
+    # Guardar lo necesario antes del commit: leer `inv` después recargaría toda la fila
+    invoice_id, label, prev = inv.id, inv.invoice_number or inv.id, inv.state.value
+    new_state = models.InvoiceState.REJECTED
+    inv.state = new_state
     db_session.add(inv)
     db_session.commit()
-    db_session.add(models.InvoiceHistory(invoice_id=inv.id, from_state=prev, to_state=inv.state.value, comment=comment))
+    db_session.add(models.InvoiceHistory(invoice_id=invoice_id, from_state=prev, to_state=new_state.value, comment=comment))
     db_session.commit()
-    return HTMLResponse(f"<h3>Factura {inv.invoice_number or inv.id} rechazada. Comentario registrado.</h3>")
+    return HTMLResponse(f"<h3>Factura {label} rechazada. Comentario registrado.</h3>")
 
 
 # ----------------------------------------------
@@ -319,7 +488,7 @@ async def handle_upload(
 # Endpoint: webhook para decisiones externas
 # --------------------------------------
 @app.post("/webhooks/decision")
-async def webhook_decision(request: Request, db_session: Session = Depends(get_db)):
+async def webhook_decision(request: Request, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)):
     """
     Espera JSON en el body:
     {
@@ -342,22 +511,31 @@ async def webhook_decision(request: Request, db_session: Session = Depends(get_d
     if not invoice_id or action not in ("approve", "reject"):
         return JSONResponse({"status": "error", "message": "Payload inválido"}, status_code=400)
 
-    inv = db_session.query(models.Invoice).filter(models.Invoice.id == invoice_id).first()
+    inv = (
+        db_session.query(models.Invoice)
+        .options(load_only(*ACTION_COLUMNS))
+        .filter(models.Invoice.id == invoice_id)
+        .first()
+    )
     if not inv:
         return JSONResponse({"status": "error", "message": "Invoice not found"}, status_code=404)
 
-    prev = inv.state.value
+    # Guardar lo necesario antes del commit: leer `inv` después recargaría toda la fila
+    inv_id, prev = inv.id, inv.state.value
     if action == "approve":
-        inv.state = models.InvoiceState.APPROVED
+        new_state = models.InvoiceState.APPROVED
         note = f"Aprobado vía webhook ({source})"
     else:
-        inv.state = models.InvoiceState.REJECTED
+        new_state = models.InvoiceState.REJECTED
         note = f"Rechazado vía webhook ({source}): {comment}"
+    inv.state = new_state
 
     db_session.add(inv)
     db_session.commit()
-    db_session.add(models.InvoiceHistory(invoice_id=inv.id, from_state=prev, to_state=inv.state.value, comment=comment or note))
+    db_session.add(models.InvoiceHistory(invoice_id=inv_id, from_state=prev, to_state=new_state.value, comment=comment or note))
     db_session.commit()
+    if action == "approve" and prev != models.InvoiceState.APPROVED.value:
+        background_tasks.add_task(learn_profile, inv_id)
 
     # Opcional: registrar webhook log si definiste WebhookLog en models.py
     try:
@@ -368,7 +546,7 @@ async def webhook_decision(request: Request, db_session: Session = Depends(get_d
     except Exception:
         pass
 
-    return {"status": "ok", "invoice_id": invoice_id, "new_state": inv.state.value}
+    return {"status": "ok", "invoice_id": invoice_id, "new_state": new_state.value}
 
 
 
@@ -0,0 +1,16 @@
+# app/migrate.py
+# Migraciones de datos explícitas: se ejecutan una vez (antes de desplegar la nueva versión)
+# y no al importar la app, para que varios workers no las corran en paralelo.
+#
+#   python -m app.migrate
+from . import db, profiles
+
+def main():
+    db.init_db()
+    db.migrate_raw_text()
+    # Perfiles de proveedor iniciales a partir de las facturas ya aprobadas
+    with db.SessionLocal() as session:
+        profiles.bootstrap(session)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, DateTime, Float, Text, Enum, JSON, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Float, Text, Enum, JSON, ForeignKey, LargeBinary
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 from .db import Base
 import enum
+import os
+import zlib
+
+# Códec para el texto OCR crudo: "zlib" (por defecto) o "none" para guardarlo sin comprimir
+RAW_TEXT_CODEC = os.getenv("RAW_TEXT_CODEC", "zlib")
 
 class InvoiceState(str, enum.Enum):
     IN_PROCESS = "En Proceso"
@@ -19,12 +24,55 @@ class Invoice(Base):
     due_date = Column(String, nullable=True)
     total_amount = Column(String, nullable=True)
     taxes = Column(String, nullable=True)
-    raw_text = Column(Text, nullable=True)
-    extracted = Column(JSON, nullable=True)  # structured dict
+    # JSON diferido: solo se carga al acceder a `inv.extracted` o con undefer()
+    extracted = deferred(Column(JSON, nullable=True))  # structured dict
     state = Column(Enum(InvoiceState), default=InvoiceState.IN_PROCESS)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     history = relationship("InvoiceHistory", back_populates="invoice")
+    # El texto OCR vive en una tabla aparte y se carga bajo demanda (lazy="select")
+    raw = relationship("InvoiceRawText", uselist=False, back_populates="invoice", cascade="all, delete-orphan")
+
+    @property
+    def raw_text(self):
+        return self.raw.text if self.raw is not None else None
+
+    @raw_text.setter
+    def raw_text(self, value):
+        if value is None:
+            self.raw = None
+        elif self.raw is None:
+            self.raw = InvoiceRawText(text=value)
+        else:
+            self.raw.text = value
+
+class InvoiceRawText(Base):
+    """
+    Texto OCR crudo de una factura, comprimido y separado de la fila principal
+    para que las consultas de `invoices` no arrastren kilobytes por fila.
+    """
+    __tablename__ = "invoice_raw_texts"
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), primary_key=True)
+    codec = Column(String, default="zlib")  # zlib/none
+    data = Column(LargeBinary, nullable=False)
+    invoice = relationship("Invoice", back_populates="raw")
+
+    @staticmethod
+    def encode(text: str, codec: str = None):
+        codec = codec or RAW_TEXT_CODEC
+        data = text.encode("utf-8")
+        if codec == "zlib":
+            return codec, zlib.compress(data, 6)
+        return "none", data
+
+    @property
+    def text(self) -> str:
+        data = zlib.decompress(self.data) if self.codec == "zlib" else self.data
+        return data.decode("utf-8")
+
+    @text.setter
+    def text(self, value: str):
+        self.codec, self.data = self.encode(value)
 
 class InvoiceHistory(Base):
     __tablename__ = "invoice_history"
@@ -44,3 +92,18 @@ class WebhookLog(Base):
     received_at = Column(DateTime(timezone=True), server_default=func.now())
     processed = Column(String, default="pending")  # pending/ok/error
     error = Column(Text, nullable=True)
+
+class ProviderProfile(Base):
+    __tablename__ = "provider_profiles"
+    fingerprint = Column(String, primary_key=True)  # p.ej. "ruc:20123456789"
+    provider_name = Column(String, nullable=True)
+    rules = Column(JSON, nullable=False)  # {campo: {"line": idx, "label": "..."}}
+    samples = Column(Integer, default=1)   # facturas aprobadas usadas para aprender
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class ProviderProfileSample(Base):
+    __tablename__ = "provider_profile_samples"
+    # Una fila por factura aprobada ya contada en un perfil: el aprendizaje no la repite
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), primary_key=True)
+    fingerprint = Column(String, nullable=True)  # None si no se pudo aprender nada
+    learned_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -1,14 +1,170 @@
 # app/nlp.py
 import re
-from typing import Dict
+import time
+import threading
+from typing import Dict, List, Optional
 
 # Reglas heurísticas para extraer campos. Puedes extender con spaCy y NER.
 date_pattern = r"(\d{1,2}[\/\-\.\s]\d{1,2}[\/\-\.\s]\d{2,4})"
 money_pattern = r"(\d{1,3}(?:[\.,]\d{3})*(?:[\.,]\d{2}))"  # simple
 
-def extract_fields(raw_text: str) -> Dict:
+FIELDS = ("provider_name", "invoice_number", "issue_date", "due_date", "total_amount", "taxes")
+
+# Patrón del valor de cada campo al aplicar un perfil (None = resto de la línea)
+FIELD_PATTERNS = {
+    "provider_name": None,
+    "invoice_number": r"([A-Za-z0-9\-_/]+)",
+    "issue_date": date_pattern,
+    "due_date": date_pattern,
+    "total_amount": money_pattern,
+    "taxes": money_pattern,
+}
+
+# Índice en memoria de perfiles por proveedor:
+# {fingerprint: {"provider_name": str, "rules": {campo: regla}}}
+PROFILE_INDEX: Dict[str, Dict] = {}
+
+_stats_lock = threading.Lock()
+_stats = {"lookups": 0, "hits": 0, "paths": {}}
+
+
+def clean_lines(raw_text: str) -> List[str]:
     text = raw_text.replace("\r", "\n")
-    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    return [l.strip() for l in text.splitlines() if l.strip()]
+
+
+def header_fingerprint(lines: List[str]) -> Optional[str]:
+    """
+    Huella barata del proveedor a partir de las líneas de cabecera:
+    RUC/NIT/RIF si aparece, si no la primera línea normalizada.
+    """
+    for l in lines[:10]:
+        m = re.search(r'\b(RUC|NIT|RIF)\b[^0-9]*([0-9][0-9\.\-]{5,})', l, re.I)
+        if m:
+            return f"{m.group(1).lower()}:{re.sub(r'[^0-9]', '', m.group(2))}"
+    if lines:
+        name = re.sub(r'[^a-z0-9]+', ' ', lines[0].lower()).strip()
+        if name:
+            return f"name:{name[:120]}"
+    return None
+
+
+def learn_rules(raw_text: str, extracted: Dict) -> Dict:
+    """
+    Aprende dónde aparece cada campo (línea y etiqueta que lo precede) a partir
+    de una factura aprobada. Solo conserva las reglas que reproducen el valor.
+    El proveedor no se aprende como regla: sale del perfil (la huella ya lo identifica).
+    """
+    lines = clean_lines(raw_text)
+    rules = {}
+    for field in FIELDS:
+        if field == "provider_name":
+            continue
+        value = extracted.get(field)
+        if not value:
+            continue
+        # Ocurrencias completas del valor: los separadores de miles/decimales cuentan como
+        # parte del número ("180,00" no coincide dentro de "1.180,00" ni "18,00" en "118,00")
+        pattern = r'(?<![0-9A-Za-z.,])' + re.escape(value) + r'(?![0-9A-Za-z]|[.,]\d)'
+        found = [(i, m.start()) for i, l in enumerate(lines) for m in re.finditer(pattern, l)]
+        # Un valor repetido (p.ej. emisión = vencimiento, subtotal = total) es ambiguo: no aprender
+        if len(found) != 1:
+            continue
+        i, pos = found[0]
+        # Etiqueta = texto fijo justo antes del valor (sin otros números de la línea)
+        label = re.split(r'\d', lines[i][:pos])[-1].strip()
+        # Sin etiqueta solo quedaría la posición, que se rompe si el OCR añade una línea
+        if not label:
+            continue
+        rule = {"line": i, "label": label}
+        if _apply_rule(lines, field, rule) == value:
+            rules[field] = rule
+    return rules
+
+
+def _apply_rule(lines: List[str], field: str, rule: Dict) -> Optional[str]:
+    idx, label = rule.get("line", 0), rule.get("label", "")
+    if not label:
+        return None
+    # Preferir la línea aprendida; si el layout se desplazó, buscar la etiqueta
+    candidates = [lines[idx]] if idx < len(lines) and label in lines[idx] else []
+    candidates += [l for l in lines if label in l]
+    pattern = FIELD_PATTERNS[field]
+    for l in candidates:
+        rest = l[l.find(label) + len(label):].strip()
+        rest = rest.lstrip(":#").strip()
+        if pattern is None:
+            if rest:
+                return rest
+            continue
+        m = re.search(pattern, rest)
+        if m:
+            return m.group(1)
+    return None
+
+
+def _apply_profile(lines: List[str], profile: Dict) -> Dict:
+    result = {"provider_name": profile.get("provider_name")}
+    for field, rule in profile.get("rules", {}).items():
+        if field in FIELD_PATTERNS and field != "provider_name":
+            result[field] = _apply_rule(lines, field, rule)
+    return result
+
+
+def _record(path: str, elapsed: float, hit: bool):
+    with _stats_lock:
+        _stats["lookups"] += 1
+        if hit:
+            _stats["hits"] += 1
+        p = _stats["paths"].setdefault(path, {"count": 0, "total_s": 0.0})
+        p["count"] += 1
+        p["total_s"] += elapsed
+
+
+def extraction_stats() -> Dict:
+    """
+    Tasa de acierto de perfiles y tiempo medio por ruta:
+    profile (solo perfil), fallback (perfil + genérico), generic.
+    """
+    with _stats_lock:
+        lookups, hits = _stats["lookups"], _stats["hits"]
+        paths = {
+            name: {"count": p["count"], "avg_ms": round(p["total_s"] * 1000 / p["count"], 3)}
+            for name, p in _stats["paths"].items()
+        }
+    return {
+        "profiles": len(PROFILE_INDEX),
+        "lookups": lookups,
+        "hits": hits,
+        "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        "paths": paths,
+    }
+
+
+def extract_fields(raw_text: str) -> Dict:
+    """
+    Aplica primero el perfil aprendido del proveedor (si existe) y completa
+    los campos faltantes con las heurísticas genéricas.
+    """
+    start = time.perf_counter()
+    lines = clean_lines(raw_text)
+    fingerprint = header_fingerprint(lines)
+    profile = PROFILE_INDEX.get(fingerprint) if fingerprint else None
+
+    result = _apply_profile(lines, profile) if profile else {}
+    if profile and all(result.get(f) for f in FIELDS):
+        path = "profile"
+    else:
+        generic = _extract_generic(lines)
+        result = {f: result.get(f) or generic[f] for f in FIELDS}
+        path = "fallback" if profile else "generic"
+    result = {f: result.get(f) for f in FIELDS}
+
+    _record(path, time.perf_counter() - start, profile is not None)
+    return result
+
+
+def _extract_generic(lines: List[str]) -> Dict:
     joined = "\n".join(lines)
 
     # Provider name: heuristics — primera línea o líneas antes de palabra "Factura" o "RUC"
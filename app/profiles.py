@@ -0,0 +1,98 @@
+# app/profiles.py
+from sqlalchemy import exists
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, load_only, selectinload
+
+from . import db, models, nlp
+
+
+def load_index(db_session: Session):
+    """
+    Carga (o recarga) los perfiles de proveedor en `nlp.PROFILE_INDEX`. Solo lee.
+    Cada worker tiene su propio índice: main.py lo recarga cada PROFILE_RELOAD_SECONDS
+    para ver los perfiles aprendidos por otros workers.
+    """
+    rows = db_session.query(
+        models.ProviderProfile.fingerprint, models.ProviderProfile.provider_name, models.ProviderProfile.rules
+    )
+    # Se reemplaza el dict entero para que extract_fields nunca vea un índice a medio cargar
+    nlp.PROFILE_INDEX = {fingerprint: _index_entry(name, rules) for fingerprint, name, rules in rows}
+
+
+def bootstrap(db_session: Session, batch_size: int = 500):
+    """
+    Aprende perfiles recorriendo las facturas ya aprobadas. Se ejecuta de forma explícita
+    (`python -m app.migrate`) con un advisory lock y se puede repetir: solo procesa las
+    facturas que aún no están en `provider_profile_samples`.
+    """
+    with db.advisory_lock(db.BOOTSTRAP_PROFILES_LOCK):
+        counted = exists().where(models.ProviderProfileSample.invoice_id == models.Invoice.id)
+        pending = _approved_query(db_session).filter(~counted).order_by(models.Invoice.id)
+        for inv in pending.yield_per(batch_size):
+            _learn(db_session, inv)
+        db_session.commit()
+
+
+def learn_from_invoice(db_session: Session, invoice_id: int):
+    """
+    Actualiza el perfil del proveedor de una factura recién aprobada
+    (en BD y en el índice en memoria de este worker).
+    """
+    inv = _approved_query(db_session).filter(models.Invoice.id == invoice_id).first()
+    if inv is None:
+        return None
+    try:
+        profile = _learn(db_session, inv)
+        db_session.commit()
+    except IntegrityError:
+        # Otro worker creó el mismo perfil (o contó la misma factura) a la vez: reintentar
+        db_session.rollback()
+        profile = _learn(db_session, inv)
+        db_session.commit()
+    if profile is not None:
+        nlp.PROFILE_INDEX[profile.fingerprint] = _index_entry(profile.provider_name, profile.rules)
+    return profile
+
+
+def _index_entry(provider_name, rules):
+    return {"provider_name": provider_name, "rules": rules or {}}
+
+
+def _approved_query(db_session: Session):
+    # raw_text vive en otra tabla: cargarlo con selectinload evita una consulta por factura
+    return (
+        db_session.query(models.Invoice)
+        .options(load_only(models.Invoice.id, models.Invoice.extracted), selectinload(models.Invoice.raw))
+        .filter(models.Invoice.state == models.InvoiceState.APPROVED)
+    )
+
+
+def _learn(db_session: Session, inv: models.Invoice):
+    if db_session.query(models.ProviderProfileSample).get(inv.id) is not None:
+        return None  # ya contada (bootstrap repetido, aprobación repetida)
+    sample = models.ProviderProfileSample(invoice_id=inv.id)
+    db_session.add(sample)
+
+    raw_text, extracted = inv.raw_text, inv.extracted
+    if not raw_text or not extracted:
+        return None
+    fingerprint = nlp.header_fingerprint(nlp.clean_lines(raw_text))
+    rules = nlp.learn_rules(raw_text, extracted)
+    provider_name = extracted.get("provider_name")
+    if not fingerprint or not (rules or provider_name):
+        return None
+    sample.fingerprint = fingerprint
+
+    profile = db_session.query(models.ProviderProfile).get(fingerprint)
+    if profile is None:
+        profile = models.ProviderProfile(fingerprint=fingerprint, provider_name=provider_name, rules=rules, samples=1)
+        db_session.add(profile)
+    else:
+        # Las reglas (y el nombre aprobado) más recientes reemplazan a las anteriores campo por campo
+        profile.provider_name = provider_name or profile.provider_name
+        merged = {**profile.rules, **rules}
+        # Descartar reglas sin etiqueta guardadas por versiones anteriores (solo posición)
+        profile.rules = {f: r for f, r in merged.items() if f != "provider_name" and r.get("label")}
+        profile.samples = (profile.samples or 0) + 1
+    db_session.flush()
+    return profile
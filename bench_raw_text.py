@@ -0,0 +1,140 @@
+# bench_raw_text.py
+"""
+Compara memoria y latencia de las consultas "calientes" de invoices con el esquema
+anterior (raw_text y extracted en la misma fila) y el actual (raw_text comprimido en
+invoice_raw_texts, extracted diferido, handlers con load_only).
+
+    python bench_raw_text.py --rows 20000 --pages 4
+
+Usa su propia base de datos (SQLite temporal por defecto); nunca la de DATABASE_URL.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--rows", type=int, default=20000)
+parser.add_argument("--pages", type=int, default=4, help="páginas OCR por factura (~3 KB c/u)")
+parser.add_argument("--lookups", type=int, default=2000)
+parser.add_argument("--url", default=None, help="URL de BD vacía para el benchmark (por defecto SQLite temporal)")
+args = parser.parse_args()
+
+_tmpdir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = args.url or f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}"
+
+from sqlalchemy import Column, Integer, String, DateTime, Text, Enum, JSON  # noqa: E402
+from sqlalchemy.orm import declarative_base, load_only  # noqa: E402
+from sqlalchemy.sql import func  # noqa: E402
+
+from app import db, models  # noqa: E402
+
+LegacyBase = declarative_base()
+
+class LegacyInvoice(LegacyBase):
+    """Esquema anterior: texto OCR y JSON en la fila caliente."""
+    __tablename__ = "legacy_invoices"
+    id = Column(Integer, primary_key=True, index=True)
+    provider_name = Column(String, nullable=True)
+    invoice_number = Column(String, nullable=True, index=True)
+    issue_date = Column(String, nullable=True)
+    due_date = Column(String, nullable=True)
+    total_amount = Column(String, nullable=True)
+    taxes = Column(String, nullable=True)
+    raw_text = Column(Text, nullable=True)
+    extracted = Column(JSON, nullable=True)
+    state = Column(Enum(models.InvoiceState), default=models.InvoiceState.IN_PROCESS)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+# Mismas columnas que main.ACTION_COLUMNS (sin importar main, que necesita OCR/FastAPI)
+ACTION_COLUMNS = (models.Invoice.id, models.Invoice.state, models.Invoice.invoice_number)
+
+WORDS = (
+    "FACTURA RUC NIT Proveedor Cantidad Descripción Precio Unitario Subtotal IVA Total "
+    "servicio producto mantenimiento transporte 12,50 1.234,00 01/02/2024 unidad caja"
+).split()
+
+
+def fake_page(rng):
+    return "\n".join(" ".join(rng.choice(WORDS) for _ in range(8)) for _ in range(60))
+
+
+def seed():
+    rng = random.Random(42)
+    pool = [fake_page(rng) for _ in range(64)]
+    db.init_db()
+    LegacyBase.metadata.create_all(bind=db.engine)
+    legacy, invoices, raws = [], [], []
+    with db.engine.begin() as conn:
+        for i in range(1, args.rows + 1):
+            raw_text = "\n".join(rng.choice(pool) for _ in range(args.pages))
+            extracted = {
+                "provider_name": f"Proveedor {i % 300}",
+                "invoice_number": f"F001-{i}",
+                "issue_date": "01/02/2024",
+                "due_date": "01/03/2024",
+                "total_amount": "1.180,00",
+                "taxes": "180,00",
+            }
+            row = dict(extracted, id=i, state=models.InvoiceState.IN_PROCESS)
+            legacy.append(dict(row, raw_text=raw_text, extracted=extracted))
+            invoices.append(dict(row, extracted=extracted))
+            codec, data = models.InvoiceRawText.encode(raw_text)
+            raws.append({"invoice_id": i, "codec": codec, "data": data})
+            if len(legacy) == 1000 or i == args.rows:
+                conn.execute(LegacyInvoice.__table__.insert(), legacy)
+                conn.execute(models.Invoice.__table__.insert(), invoices)
+                conn.execute(models.InvoiceRawText.__table__.insert(), raws)
+                legacy, invoices, raws = [], [], []
+
+
+def measure(name, run):
+    # Pasada de calentamiento (caché de páginas de la BD y de consultas compiladas),
+    # luego tiempo sin tracemalloc (lo ralentiza) y memoria pico en otra pasada
+    for _ in range(2):
+        session = db.SessionLocal()
+        run(session)
+        session.close()
+    session = db.SessionLocal()
+    start = time.perf_counter()
+    run(session)
+    elapsed = time.perf_counter() - start
+    session.close()
+
+    session = db.SessionLocal()
+    tracemalloc.start()
+    run(session)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    session.close()
+    print(f"{name:<44} {elapsed * 1000:>10.1f} ms {peak / 2**20:>10.1f} MiB")
+
+
+def main():
+    print(f"Sembrando {args.rows} filas ({args.pages} páginas OCR c/u) en {db.engine.url} ...")
+    seed()
+    ids = random.Random(7).choices(range(1, args.rows + 1), k=args.lookups)
+
+    print(f"\nEscaneo completo ({args.rows} filas){'':<14} {'tiempo':>13} {'pico':>14}")
+    measure("antes:   query(Invoice) fila completa", lambda s: s.query(LegacyInvoice).all())
+    measure("después: query(Invoice) (diferido/lazy)", lambda s: s.query(models.Invoice).all())
+    measure("después: load_only(ACTION_COLUMNS)",
+            lambda s: s.query(models.Invoice).options(load_only(*ACTION_COLUMNS)).all())
+
+    print(f"\nBúsquedas por id ({args.lookups}, como los handlers){'':<3} {'tiempo':>13} {'pico':>14}")
+    measure("antes:   filter(id).first() fila completa",
+            lambda s: [s.query(LegacyInvoice).filter(LegacyInvoice.id == i).first() for i in ids])
+    measure("después: filter(id).first() load_only",
+            lambda s: [s.query(models.Invoice).options(load_only(*ACTION_COLUMNS))
+                       .filter(models.Invoice.id == i).first() for i in ids])
+
+    legacy_size = sum(len(r[0] or "") for r in db.SessionLocal().query(LegacyInvoice.raw_text))
+    packed_size = sum(len(r[0]) for r in db.SessionLocal().query(models.InvoiceRawText.data))
+    print(f"\nraw_text: {legacy_size / 2**20:.1f} MiB sin comprimir -> {packed_size / 2**20:.1f} MiB con zlib")
+
+
+if __name__ == "__main__":
+    main()